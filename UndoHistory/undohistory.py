@@ -20,22 +20,51 @@
 
 """SQLite database with undo history."""
 
+import os
 import pickle
+import random
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
-from time import time_ns
-from typing import List, Optional
+from time import sleep, time_ns
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
 from gramps.gen.const import GRAMPS_LOCALE as glocale
 from gramps.gen.db import REFERENCE_KEY, TXNADD, TXNDEL, TXNUPD, DbUndo, DbWriteBase
 from gramps.gen.db.dbconst import CLASS_TO_KEY_MAP, KEY_TO_CLASS_MAP, KEY_TO_NAME_MAP
 from gramps.gen.db.txn import DbTxn
 from gramps.plugins.db.dbapi.sqlite import SQLite
-from sqlalchemy import BLOB, Column, Integer, Text, create_engine
+from sqlalchemy import (
+    BLOB,
+    Column,
+    Integer,
+    Text,
+    create_engine,
+    event,
+    select,
+    text,
+    tuple_,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.sql import func
 
 _ = glocale.translation.gettext
 
+T = TypeVar("T")
+
 Base = declarative_base()
 
 
@@ -68,37 +97,219 @@ class Transaction(Base):
     id = Column(Integer, primary_key=True)
     session = Column(Integer)
     description = Column(Text)
-    timestamp = Column(Integer)
+    timestamp = Column(Integer, index=True)
     first = Column(Integer)
     last = Column(Integer)
     undo = Column(Integer)
 
 
+class HistoryChange(NamedTuple):
+    """Net change of an object between two points in history."""
+
+    obj_class: str
+    obj_handle: str
+    trans_type: int
+    old_data: Any
+    new_data: Any
+
+
+class HistoryCommit(NamedTuple):
+    """Decoded row of the commits table."""
+
+    session: int
+    id: int
+    obj_class: str
+    trans_type: int
+    obj_handle: str
+    ref_handle: Optional[str]
+    old_data: Any
+    new_data: Any
+    timestamp: int
+
+
+def _decode_data(data: Optional[bytes], extract: Optional[Callable[[Any], Any]]):
+    """Unpickle object data and apply the optional extraction function."""
+    if data is None:
+        return None
+    data = pickle.loads(data)
+    if extract is not None:
+        data = extract(data)
+    return data
+
+
+def _decode_commits(
+    rows: List[tuple], extract: Optional[Callable[[Any], Any]] = None
+) -> List[HistoryCommit]:
+    """Decode a chunk of rows of the commits table."""
+    commits = []
+    for row in rows:
+        commit = HistoryCommit(*row)
+        commits.append(
+            commit._replace(
+                old_data=_decode_data(commit.old_data, extract),
+                new_data=_decode_data(commit.new_data, extract),
+            )
+        )
+    return commits
+
+
+def _select_commits(
+    engine: Engine, lower: Tuple[int, int], upper: Tuple[int, int]
+) -> List[tuple]:
+    """Read the rows of the commits table after ``lower`` up to ``upper``.
+
+    Both bounds are (session, id) keys.
+    """
+    key = tuple_(Undo.session, Undo.id)
+    with engine.connect() as connection:
+        return connection.execute(
+            select(
+                Undo.session,
+                Undo.id,
+                Undo.obj_class,
+                Undo.trans_type,
+                Undo.obj_handle,
+                Undo.ref_handle,
+                Undo.old_data,
+                Undo.new_data,
+                Undo.timestamp,
+            )
+            .where(key > lower, key <= upper)
+            .order_by(Undo.session, Undo.id)
+        ).all()
+
+
+# engines of the worker processes of iter_commits, by database URL
+_worker_engines: Dict[str, Engine] = {}
+
+
+def _load_commits(
+    dburl: str,
+    lower: Tuple[int, int],
+    upper: Tuple[int, int],
+    extract: Optional[Callable[[Any], Any]] = None,
+) -> List[HistoryCommit]:
+    """Read and decode a range of commits in a worker process."""
+    engine = _worker_engines.get(dburl)
+    if engine is None:
+        engine = _worker_engines[dburl] = create_engine(dburl)
+    return _decode_commits(_select_commits(engine, lower, upper), extract)
+
+
+# Every commit touched by a transaction in the range is an event mapping the
+# object from one state to another; undo transactions apply their commits in
+# reverse. Per object, the net change goes from the state before its first
+# event to the state after its last one.
+_DIFF_HISTORY_SQL = """
+WITH events AS (
+    SELECT
+        c.obj_class AS obj_class,
+        c.obj_handle AS obj_handle,
+        CASE WHEN t.undo THEN c.new_data ELSE c.old_data END AS before,
+        CASE WHEN t.undo THEN c.old_data ELSE c.new_data END AS after,
+        t.id AS txn_id,
+        CASE WHEN t.undo THEN -c.id ELSE c.id END AS seq
+    FROM transactions AS t
+    JOIN commits AS c
+        ON c.session = t.session AND c.id BETWEEN t.first AND t.last
+    WHERE {where}
+),
+changes AS (
+    SELECT
+        obj_class,
+        obj_handle,
+        FIRST_VALUE(before) OVER w AS old_data,
+        LAST_VALUE(after) OVER w AS new_data,
+        ROW_NUMBER() OVER w AS row_number
+    FROM events
+    WINDOW w AS (
+        PARTITION BY obj_class, obj_handle
+        ORDER BY txn_id, seq
+        ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+    )
+)
+SELECT obj_class, obj_handle, old_data, new_data
+FROM changes
+WHERE row_number = 1
+    AND (old_data IS NOT NULL OR new_data IS NOT NULL)
+    AND old_data IS NOT new_data
+ORDER BY obj_class, obj_handle
+"""
+
+
 class DbUndoSQLite(SQLite):
     """SQLite database backend with undo history."""
 
+    # milliseconds to wait for a lock on the undo history database
+    undo_busy_timeout = 5000
+    # number of retries if the undo history database stays locked
+    undo_max_retries = 10
+
     def _create_undo_manager(self) -> DbUndo:
         """Create the undo manager."""
         path = self.undolog
-        return DbUndoSQL(grampsdb=self, dburl=f"sqlite:///{path}")
+        return DbUndoSQL(
+            grampsdb=self,
+            dburl=f"sqlite:///{path}",
+            busy_timeout=self.undo_busy_timeout,
+            max_retries=self.undo_max_retries,
+        )
 
 
 class DbUndoSQL(DbUndo):
     """SQL-based undo database."""
 
     def __init__(
-        self, grampsdb: DbWriteBase, dburl: str, treeid: Optional[int] = None
+        self,
+        grampsdb: DbWriteBase,
+        dburl: str,
+        treeid: Optional[int] = None,
+        busy_timeout: int = 5000,
+        max_retries: int = 10,
     ) -> None:
         DbUndo.__init__(self, grampsdb)
         self._session_id: Optional[int] = None
         self.treeid = None
         self.undodb: List[bytes] = []
+        self.busy_timeout = busy_timeout
+        self.max_retries = max_retries
+        self.dburl = dburl
         self.engine = create_engine(dburl)
+        if self.engine.dialect.name == "sqlite":
+            self._setup_sqlite_locking()
+
+    def _setup_sqlite_locking(self) -> None:
+        """Make SQLite write transactions safe for concurrent processes.
+
+        The driver's implicit transaction handling is disabled so that write
+        transactions can be started with ``BEGIN IMMEDIATE``, acquiring the
+        write lock up front rather than failing on lock upgrade midway. The
+        write-ahead log lets readers in other processes proceed while a
+        write is in progress, and vice versa.
+        """
+
+        @event.listens_for(self.engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+            dbapi_connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+            dbapi_connection.execute("PRAGMA journal_mode = WAL")
+
+        @event.listens_for(self.engine, "begin")
+        def on_begin(conn):
+            if conn.get_execution_options().get("immediate"):
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            else:
+                conn.exec_driver_sql("BEGIN")
 
     @contextmanager
-    def session_scope(self):
-        """Provide a transactional scope around a series of operations."""
-        SQLSession = sessionmaker(self.engine)
+    def session_scope(self, write: bool = False):
+        """Provide a transactional scope around a series of operations.
+
+        With ``write=True``, the transaction takes the database write lock
+        when it begins.
+        """
+        engine = self.engine.execution_options(immediate=True) if write else self.engine
+        SQLSession = sessionmaker(engine)
         session = SQLSession()
         try:
             yield session
@@ -109,6 +320,26 @@ class DbUndoSQL(DbUndo):
         finally:
             session.close()
 
+    def _write(self, operation: Callable[..., T]) -> T:
+        """Run a write operation in its own transaction.
+
+        If the database stays locked beyond the busy timeout, the operation is
+        retried with jittered exponential backoff.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.session_scope(write=True) as session:
+                    return operation(session)
+            except OperationalError as exc:
+                message = str(exc.orig).lower()
+                if attempt >= self.max_retries or (
+                    "locked" not in message and "busy" not in message
+                ):
+                    raise
+            sleep(min(0.01 * 2**attempt, 1.0) * random.uniform(0.5, 1.5))
+            attempt += 1
+
     @property
     def session_id(self) -> int:
         """Return the cached session ID or create if not exists."""
@@ -121,34 +352,46 @@ class DbUndoSQL(DbUndo):
         Open the backing storage.
         """
         Base.metadata.create_all(self.engine)
+        for index in Transaction.__table__.indexes:
+            # tables created by earlier versions lack the index
+            index.create(self.engine, checkfirst=True)
 
     def _make_session_id(self) -> int:
         """Insert a row into the session table."""
-        with self.session_scope() as session:
+
+        def insert(session) -> int:
             new_session = Session(timestamp=time_ns(), treeid=self.treeid)
             session.add(new_session)
-            session.commit()
+            session.flush()
             return new_session.id
 
+        return self._write(insert)
+
     def close(self) -> None:
         """Close the backing storage."""
         pass
 
-    def append(self, value) -> None:
-        """Add a new entry on the end."""
+    def append(self, value) -> int:
+        """Add a new entry on the end and return its index."""
         (obj_type, trans_type, handle, old_data, new_data) = pickle.loads(value)
         if isinstance(handle, tuple):
             obj_handle, ref_handle = handle
         else:
             obj_handle, ref_handle = (handle, None)
-        length = len(self)
+        old_data = None if old_data is None else pickle.dumps(old_data, protocol=1)
+        new_data = None if new_data is None else pickle.dumps(new_data, protocol=1)
         session_id = self.session_id  # outside session to prevent lock error
-        with self.session_scope() as session:
-            old_data = None if old_data is None else pickle.dumps(old_data, protocol=1)
-            new_data = None if new_data is None else pickle.dumps(new_data, protocol=1)
+
+        def insert(session) -> int:
+            # the ID is allocated under the write lock, so it cannot collide
+            max_id = (
+                session.query(func.max(Undo.id))
+                .filter(Undo.session == session_id)
+                .scalar()
+            )
             new_undo = Undo(
                 session=session_id,
-                id=length + 1,
+                id=(max_id or 0) + 1,
                 obj_class=KEY_TO_CLASS_MAP.get(obj_type, str(obj_type)),
                 trans_type=trans_type,
                 obj_handle=obj_handle,
@@ -158,7 +401,9 @@ class DbUndoSQL(DbUndo):
                 timestamp=time_ns(),
             )
             session.add(new_undo)
-            session.commit()
+            return new_undo.id
+
+        return self._write(insert) - 1  # SQL id vs Python index off-by-1
 
     def _after_commit(
         self, transaction: DbTxn, undo: bool = False, redo: bool = False
@@ -182,7 +427,8 @@ class DbUndoSQL(DbUndo):
         else:
             last = transaction.last + 1
         session_id = self.session_id  # outside session to prevent lock error
-        with self.session_scope() as session:
+
+        def insert(session) -> None:
             new_transaction = Transaction(
                 session=session_id,
                 description=msg,
@@ -191,8 +437,9 @@ class DbUndoSQL(DbUndo):
                 last=last,
                 undo=int(undo),
             )
-        session.add(new_transaction)
-        session.commit()
+            session.add(new_transaction)
+
+        self._write(insert)
 
     def __getitem__(self, index: int) -> bytes:
         """
@@ -244,7 +491,8 @@ class DbUndoSQL(DbUndo):
         else:
             obj_handle, ref_handle = (handle, None)
         session_id = self.session_id  # outside session to prevent lock error
-        with self.session_scope() as session:
+
+        def update(session) -> None:
             undo_record = (
                 session.query(Undo)
                 .filter(Undo.session == session_id, Undo.id == index + 1)
@@ -266,7 +514,7 @@ class DbUndoSQL(DbUndo):
             )
             undo_record.timestamp = time_ns()
 
-            session.commit()
+        self._write(update)
 
     def __len__(self) -> int:
         """Returns the number of entries."""
@@ -279,6 +527,148 @@ class DbUndoSQL(DbUndo):
             )
         return max_id or 0
 
+    def diff_history(
+        self,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        by_transaction: bool = False,
+        batch_size: int = 1000,
+    ) -> Iterator[HistoryChange]:
+        """
+        Yield the net change of each object between two points in history.
+
+        The range covers transactions with a timestamp (in nanoseconds) or,
+        if ``by_transaction`` is set, a transaction ID greater than ``start``
+        and up to ``end``; either bound can be omitted. Intermediate edits
+        and undone changes are collapsed, and objects that end up unchanged
+        are skipped. Changes are yielded ordered by object class and handle.
+        """
+        column = "t.id" if by_transaction else "t.timestamp"
+        conditions = ["c.ref_handle IS NULL"]
+        # only add the given bounds, so that the range can use an index
+        if start is not None:
+            conditions.append(f"{column} > :start")
+        if end is not None:
+            conditions.append(f"{column} <= :end")
+        sql = _DIFF_HISTORY_SQL.format(where=" AND ".join(conditions))
+        # the result is staged in a temporary table and read in batches,
+        # each in its own transaction, so a slow consumer does not keep a
+        # read transaction open on the history
+        # a table of its own for every call, as pooled connections are shared
+        table = f"temp.diff_history_{uuid.uuid4().hex}"
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(
+                    text(f"CREATE TABLE {table} AS {sql}"),
+                    {"start": start, "end": end},
+                )
+            try:
+                last = 0
+                while True:
+                    with connection.begin():
+                        rows = connection.execute(
+                            text(
+                                "SELECT rowid, obj_class, obj_handle, old_data, "
+                                f"new_data FROM {table} WHERE rowid > :last "
+                                "ORDER BY rowid LIMIT :limit"
+                            ),
+                            {"last": last, "limit": batch_size},
+                        ).all()
+                    if not rows:
+                        return
+                    for rowid, obj_class, obj_handle, old_data, new_data in rows:
+                        if old_data is None:
+                            trans_type = TXNADD
+                        elif new_data is None:
+                            trans_type = TXNDEL
+                        else:
+                            trans_type = TXNUPD
+                        yield HistoryChange(
+                            obj_class=obj_class,
+                            obj_handle=obj_handle,
+                            trans_type=trans_type,
+                            old_data=_decode_data(old_data, None),
+                            new_data=_decode_data(new_data, None),
+                        )
+                    last = rowid
+            finally:
+                with connection.begin():
+                    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
+
+    def _commit_ranges(
+        self, chunk_size: int
+    ) -> Iterator[Tuple[Tuple[int, int], Tuple[int, int]]]:
+        """
+        Split the commits table into chunks of ``chunk_size`` commits.
+
+        Chunks span sessions and are yielded as the (session, id) keys after
+        which they start and with which they end. Only the primary key index
+        is read, with a short transaction for every chunk.
+        """
+        with self.session_scope() as session:
+            last = (
+                session.query(Undo.session, Undo.id)
+                .order_by(Undo.session.desc(), Undo.id.desc())
+                .first()
+            )
+        if last is None:
+            return
+        last = tuple(last)
+        lower = (0, 0)
+        while lower != last:
+            with self.session_scope() as session:
+                upper = (
+                    session.query(Undo.session, Undo.id)
+                    .filter(tuple_(Undo.session, Undo.id) > lower)
+                    .order_by(Undo.session, Undo.id)
+                    .offset(chunk_size - 1)
+                    .first()
+                )
+            # commits appended after the scan started are left out
+            upper = last if upper is None else min(tuple(upper), last)
+            yield lower, upper
+            lower = upper
+
+    def iter_commits(
+        self,
+        workers: Optional[int] = None,
+        chunk_size: int = 10000,
+        extract: Optional[Callable[[Any], Any]] = None,
+    ) -> Iterator[HistoryCommit]:
+        """
+        Yield all commits of all sessions with their data unpickled.
+
+        The commits are split into chunks of ``chunk_size`` commits, which
+        may span sessions, that are read and decoded by a pool of ``workers``
+        processes, each with its own database connection (by default, one
+        per CPU; ``0`` reads and decodes in this process). If given, ``extract`` is applied to each
+        non-empty data tuple in the worker and its result is returned
+        instead; it must be picklable, e.g. a module-level function. Commits
+        are yielded in order of session and ID.
+
+        Decoded data has to be sent back from the workers, so the pool pays
+        off mostly if ``extract`` reduces it to the fields actually needed.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        ranges = self._commit_ranges(chunk_size)
+        if workers == 0:
+            for lower, upper in ranges:
+                rows = _select_commits(self.engine, lower, upper)
+                yield from _decode_commits(rows, extract)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for lower, upper in ranges:
+                pending.append(
+                    executor.submit(_load_commits, self.dburl, lower, upper, extract)
+                )
+                # bound the number of decoded chunks held in memory
+                if len(pending) > 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
     def _redo(self, update_history: bool) -> bool:
         """
         Access the last undone transaction, and revert the data to the state
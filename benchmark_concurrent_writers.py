@@ -0,0 +1,78 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2024 David Straub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Benchmark several processes writing to the same undo history."""
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+from gramps.gen.db import TXNADD
+from gramps.gen.db.dbconst import PERSON_KEY
+from gramps.gen.lib import Person
+
+from UndoHistory.undohistory import DbUndoSQL
+
+
+def append_commits(dburl: str, count: int) -> None:
+    """Append commits to the history from a separate process."""
+    dbundo = DbUndoSQL(grampsdb=None, dburl=dburl)
+    for i in range(count):
+        person = Person()
+        person.set_handle(f"{os.getpid()}-{i}")
+        dbundo.append(
+            pickle.dumps(
+                (PERSON_KEY, TXNADD, person.handle, None, person.serialize()), 1
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commits", type=int, default=250, help="per writer")
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    for writers in args.writers:
+        dbdir = tempfile.mkdtemp()
+        try:
+            dburl = f"sqlite:///{os.path.join(dbdir, 'undo.db')}"
+            dbundo = DbUndoSQL(grampsdb=None, dburl=dburl)
+            dbundo.open()
+            start = time.perf_counter()
+            with multiprocessing.Pool(writers) as pool:
+                pool.starmap(append_commits, [(dburl, args.commits)] * writers)
+            elapsed = time.perf_counter() - start
+            total = writers * args.commits
+            print(
+                f"writers={writers:3d}: {total} commits in {elapsed:6.2f} s, "
+                f"{total / elapsed:7.0f} commits/s"
+            )
+            dbundo.engine.dispose()
+        finally:
+            shutil.rmtree(dbdir)
+
+
+if __name__ == "__main__":
+    main()
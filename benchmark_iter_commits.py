@@ -0,0 +1,137 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2024 David Straub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Benchmark bulk decoding of the undo history with several processes."""
+
+import argparse
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+from gramps.gen.db import TXNUPD
+from gramps.gen.lib import Name, Person, Surname
+from sqlalchemy import insert
+
+from UndoHistory.undohistory import DbUndoSQL, Session, Undo
+
+
+def _get_gramps_id(data):
+    """Extract the Gramps ID from serialized person data."""
+    return data[1]
+
+
+def populate(
+    dbundo: DbUndoSQL, commits: int, session_size: int, batch_size: int = 10000
+) -> None:
+    """Fill the history with modifications of a person.
+
+    Every ``session_size`` commits, a new session is started.
+    """
+    person = Person()
+    person.set_handle("benchmark")
+    surname = Surname()
+    surname.set_surname("Benchmark")
+    name = Name()
+    name.set_first_name("Benchmark")
+    name.add_surname(surname)
+    person.set_primary_name(name)
+    old_data = None
+    with dbundo.session_scope(write=True) as session:
+        for start in range(1, commits + 1, batch_size):
+            rows = []
+            for i in range(start, min(start + batch_size, commits + 1)):
+                session_id, commit_id = divmod(i - 1, session_size)
+                if commit_id == 0:
+                    session.add(Session(id=session_id + 1, timestamp=time.time_ns()))
+                person.set_gramps_id(f"I{i:07d}")
+                new_data = pickle.dumps(person.serialize(), protocol=1)
+                rows.append(
+                    {
+                        "session": session_id + 1,
+                        "id": commit_id + 1,
+                        "obj_class": "Person",
+                        "trans_type": TXNUPD,
+                        "obj_handle": person.handle,
+                        "old_data": old_data,
+                        "new_data": new_data,
+                        "timestamp": time.time_ns(),
+                    }
+                )
+                old_data = new_data
+            session.execute(insert(Undo), rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commits", type=int, default=1_000_000)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument(
+        "--session-size",
+        type=int,
+        default=1_000_000,
+        help="commits per session (small values mimic many writer processes)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2, 4, 8, os.cpu_count() or 1],
+        help="worker counts to compare (0 decodes in the reading process)",
+    )
+    args = parser.parse_args()
+
+    dbdir = tempfile.mkdtemp()
+    try:
+        dbundo = DbUndoSQL(
+            grampsdb=None, dburl=f"sqlite:///{os.path.join(dbdir, 'undo.db')}"
+        )
+        dbundo.open()
+        start = time.perf_counter()
+        populate(dbundo, args.commits, args.session_size)
+        print(
+            f"populated {args.commits} commits in {time.perf_counter() - start:.1f} s"
+        )
+        baseline = None
+        for workers in sorted(set(args.workers)):
+            start = time.perf_counter()
+            start_cpu = time.process_time()
+            commits = dbundo.iter_commits(
+                workers=workers, chunk_size=args.chunk_size, extract=_get_gramps_id
+            )
+            count = sum(1 for _ in commits)
+            elapsed = time.perf_counter() - start
+            # CPU time of this process is the part that does not parallelize
+            parent_cpu = time.process_time() - start_cpu
+            assert count == args.commits
+            baseline = baseline or elapsed
+            print(
+                f"workers={workers:3d}: {elapsed:6.2f} s, "
+                f"{count / elapsed:9.0f} commits/s, "
+                f"speedup {baseline / elapsed:4.1f}x, "
+                f"parent CPU {parent_cpu:6.2f} s"
+            )
+    finally:
+        shutil.rmtree(dbdir)
+
+
+if __name__ == "__main__":
+    main()
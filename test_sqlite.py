@@ -20,16 +20,19 @@
 
 """Unit tests for the Undo History addon."""
 
+import multiprocessing
 import os
 import pickle
 import shutil
 import tempfile
 import time
 import unittest
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from gramps.gen.config import config
-from gramps.gen.db import DbTxn, DbWriteBase
-from gramps.gen.db.dbconst import DBBACKEND
+from gramps.gen.db import TXNADD, TXNDEL, TXNUPD, DbTxn, DbWriteBase
+from gramps.gen.db.dbconst import DBBACKEND, PERSON_KEY
 from gramps.gen.db.utils import make_database
 from gramps.gen.lib import (
     Citation,
@@ -45,6 +48,8 @@ from gramps.gen.lib import (
 )
 from sqlalchemy import text
 
+from UndoHistory.undohistory import DbUndoSQL
+
 DBID = "sqlite+history"
 
 
@@ -55,6 +60,29 @@ def dict_factory(cursor, row):
     return d
 
 
+def _append_commits(dburl, count):
+    """Append commits in a new session.
+
+    Returns the session ID and the indices of the new commits.
+    """
+    dbundo = DbUndoSQL(grampsdb=None, dburl=dburl)
+    indices = []
+    for _ in range(count):
+        person = Person()
+        person.set_handle(uuid.uuid4().hex)
+        value = pickle.dumps(
+            (PERSON_KEY, TXNADD, person.handle, None, person.serialize()), 1
+        )
+        indices.append(dbundo.append(value))
+    dbundo.engine.dispose()
+    return dbundo.session_id, indices
+
+
+def _get_handle(data):
+    """Extract the handle from serialized object data."""
+    return data[0]
+
+
 class TestUndoHistory(unittest.TestCase):
     """Tests Undo History Addon."""
 
@@ -219,3 +247,179 @@ class TestUndoHistory(unittest.TestCase):
         assert pickle.loads(commit["new_data"]) == person.serialize()
         assert pickle.loads(commit["new_data"]) == new_person.serialize()
         assert pickle.loads(commit["old_data"]) == old_person.serialize()
+
+    def test_diff_history(self):
+        dbundo = self.db.get_undodb()
+        changes = list(dbundo.diff_history())
+        assert len(changes) == 100
+        assert {change.trans_type for change in changes} == {TXNADD}
+        assert all(change.old_data is None for change in changes)
+        start = self._get_history_table("transactions")[-1]["timestamp"]
+        people = list(self.db.iter_people())
+        old_person, deleted_person, undone_person = people[:3]
+        person = self.db.get_person_from_handle(old_person.handle)
+        person.gramps_id = "I9999"
+        with DbTxn("Modify person", self.db) as trans:
+            self.db.commit_person(person, trans)
+        person.gramps_id = "I9998"
+        with DbTxn("Modify person again", self.db) as trans:
+            self.db.commit_person(person, trans)
+        with DbTxn("Delete person", self.db) as trans:
+            self.db.delete_person_from_database(deleted_person, trans)
+        undone_person.gramps_id = "I9997"
+        with DbTxn("Modify person", self.db) as trans:
+            self.db.commit_person(undone_person, trans)
+        self.db.undo()
+        self.db.redo()
+        self.db.undo()
+        changes = list(dbundo.diff_history(start))
+        assert len(changes) == 2
+        changes = {change.obj_handle: change for change in changes}
+        modified = changes[old_person.handle]
+        assert modified.obj_class == "Person"
+        assert modified.trans_type == TXNUPD
+        assert modified.old_data == old_person.serialize()
+        assert modified.new_data == person.serialize()
+        deleted = changes[deleted_person.handle]
+        assert deleted.trans_type == TXNDEL
+        assert deleted.old_data == deleted_person.serialize()
+        assert deleted.new_data is None
+        changes = list(dbundo.diff_history(1, 2, by_transaction=True))
+        assert len(changes) == 1
+        assert changes[0].new_data[1] == "I9999"
+        assert len(list(dbundo.diff_history(end=start))) == 100
+
+    def test_diff_history_concurrent_write(self):
+        dbundo = self.db.get_undodb()
+        changes = dbundo.diff_history(batch_size=1)
+        first = next(changes)
+        writer = DbUndoSQL(
+            grampsdb=None, dburl=str(dbundo.engine.url), busy_timeout=100, max_retries=0
+        )
+        person = Person()
+        person.set_handle("concurrent")
+        value = pickle.dumps(
+            (PERSON_KEY, TXNADD, person.handle, None, person.serialize()), 1
+        )
+        assert writer.append(value) == 0
+        assert len([first, *changes]) == 100
+        writer.engine.dispose()
+
+    def test_diff_history_interleaved(self):
+        dbundo = self.db.get_undodb()
+        changes = dbundo.diff_history(batch_size=1)
+        first = next(changes)
+        assert len(list(dbundo.diff_history(batch_size=1))) == 100
+        assert len([first, *changes]) == 100
+
+    def test_iter_commits(self):
+        dbundo = self.db.get_undodb()
+        rows = self._get_history_table("commits")
+        commits = list(dbundo.iter_commits(workers=0))
+        assert len(commits) == 100
+        for commit, row in zip(commits, rows):
+            assert commit.session == row["session"]
+            assert commit.id == row["id"]
+            assert commit.obj_class == row["obj_class"]
+            assert commit.obj_handle == row["obj_handle"]
+            assert commit.old_data is None
+            assert commit.new_data == pickle.loads(row["new_data"])
+        assert list(dbundo.iter_commits(workers=2, chunk_size=7)) == commits
+        handles = list(
+            dbundo.iter_commits(workers=2, chunk_size=7, extract=_get_handle)
+        )
+        assert [commit.new_data for commit in handles] == [
+            commit.obj_handle for commit in commits
+        ]
+
+
+class TestConcurrentWriters(unittest.TestCase):
+    """Tests several processes writing to the same history database."""
+
+    writers = 4
+    commits_per_writer = 25
+
+    def setUp(self) -> None:
+        self.dbdir = tempfile.mkdtemp()
+        self.dburl = f"sqlite:///{os.path.join(self.dbdir, 'undo.db')}"
+        self.dbundo = DbUndoSQL(grampsdb=None, dburl=self.dburl)
+        self.dbundo.open()
+
+    def tearDown(self):
+        self.dbundo.engine.dispose()
+        shutil.rmtree(self.dbdir)
+
+    def _get_commits(self):
+        """Get all commits."""
+        with self.dbundo.session_scope() as session:
+            return session.execute(
+                text("SELECT session, id, obj_handle FROM commits")
+            ).all()
+
+    def test_separate_sessions(self):
+        with multiprocessing.Pool(self.writers) as pool:
+            results = pool.starmap(
+                _append_commits,
+                [(self.dburl, self.commits_per_writer)] * self.writers,
+            )
+        session_ids = [session_id for session_id, _ in results]
+        assert len(set(session_ids)) == self.writers
+        for _, indices in results:
+            assert indices == list(range(self.commits_per_writer))
+        with self.dbundo.session_scope() as session:
+            sessions = session.execute(text("SELECT id FROM sessions")).all()
+            assert sorted(row.id for row in sessions) == sorted(session_ids)
+        commits = self._get_commits()
+        total = self.writers * self.commits_per_writer
+        assert len(commits) == total
+        for session_id in session_ids:
+            ids = sorted(row.id for row in commits if row.session == session_id)
+            assert ids == list(range(1, self.commits_per_writer + 1))
+        assert len({row.obj_handle for row in commits}) == total
+
+    def test_concurrent_instances(self):
+        with ThreadPoolExecutor(self.writers) as executor:
+            results = list(
+                executor.map(
+                    _append_commits,
+                    [self.dburl] * self.writers,
+                    [self.commits_per_writer] * self.writers,
+                )
+            )
+        session_ids = [session_id for session_id, _ in results]
+        assert len(set(session_ids)) == self.writers
+        for _, indices in results:
+            assert indices == list(range(self.commits_per_writer))
+        commits = self._get_commits()
+        assert len(commits) == self.writers * self.commits_per_writer
+        for session_id in session_ids:
+            ids = sorted(row.id for row in commits if row.session == session_id)
+            assert ids == list(range(1, self.commits_per_writer + 1))
+
+
+class TestIterCommits(unittest.TestCase):
+    """Tests bulk reads of a history with many small sessions."""
+
+    sessions = 20
+    commits_per_session = 3
+
+    def setUp(self) -> None:
+        self.dbdir = tempfile.mkdtemp()
+        self.dburl = f"sqlite:///{os.path.join(self.dbdir, 'undo.db')}"
+        self.dbundo = DbUndoSQL(grampsdb=None, dburl=self.dburl)
+        self.dbundo.open()
+        for _ in range(self.sessions):
+            _append_commits(self.dburl, self.commits_per_session)
+
+    def tearDown(self):
+        self.dbundo.engine.dispose()
+        shutil.rmtree(self.dbdir)
+
+    def test_chunks_span_sessions(self):
+        ranges = list(self.dbundo._commit_ranges(10))
+        assert len(ranges) == 6
+        commits = list(self.dbundo.iter_commits(workers=0, chunk_size=10))
+        assert len(commits) == self.sessions * self.commits_per_session
+        keys = [(commit.session, commit.id) for commit in commits]
+        assert keys == sorted(set(keys))
+        assert list(self.dbundo.iter_commits(workers=2, chunk_size=10)) == commits